@@ -3,7 +3,11 @@ import io
 import json
 import os
 import threading
-from typing import List, Tuple, Optional
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Dict, List, Tuple, Optional
 
 import cv2
 import numpy as np
@@ -12,17 +16,54 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
+try:
+    # SIMD 加速的 base64 解码；未安装则回退标准库
+    import pybase64 as _b64
+except ImportError:
+    _b64 = base64
+
+try:
+    # C 实现的 JSON，标签读写快 3-5 倍；未安装则回退标准库
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+try:
+    # libjpeg-turbo 用 SIMD 做 IDCT 并直接输出灰度；构造失败(缺动态库)同样回退
+    from turbojpeg import TurboJPEG, TJPF_GRAY
+    _turbo = TurboJPEG()
+except Exception:
+    _turbo = None
+
+try:
+    # 嵌入向量识别后端(见 _get_embedder)；未安装则始终走 LBPH
+    import onnxruntime as _ort
+except ImportError:
+    _ort = None
+
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATASET_DIR = os.path.join(BASE_DIR, "dataset")
 MODEL_DIR = os.path.join(BASE_DIR, "model")
 LABELS_PATH = os.path.join(MODEL_DIR, "labels.json")
 TRAINER_PATH = os.path.join(MODEL_DIR, "trainer.yml")
+TRAINED_FILES_PATH = os.path.join(MODEL_DIR, "trained_files.json")
+EMBEDDER_PATH = os.path.join(MODEL_DIR, "face_embedder.onnx")
+EMBEDDINGS_PATH = os.path.join(MODEL_DIR, "embeddings.npz")
+# 置 False 可强制回退 LBPH，即使嵌入模型可用
+USE_EMBEDDINGS: bool = True
 CASCADE_PATH = os.path.join(BASE_DIR, "haarcascade_frontalface_default.xml")
 
 os.makedirs(DATASET_DIR, exist_ok=True)
 os.makedirs(MODEL_DIR, exist_ok=True)
 
+# 有 GPU/核显时让 OpenCV 把级联检测分发到 OpenCL 内核,否则保持 CPU 路径
+try:
+    cv2.ocl.setUseOpenCL(True)
+    _HAS_OCL = bool(cv2.ocl.haveOpenCL())
+except Exception:
+    _HAS_OCL = False
+
 
 def ensure_cascade() -> str:
     # Prefer OpenCV built-in cascades path to avoid network dependency
@@ -43,29 +84,62 @@ def ensure_cascade() -> str:
     )
 
 
+@lru_cache(maxsize=1)
+def _get_cascade_path() -> str:
+    return ensure_cascade()
+
+
+_cascade_tls = threading.local()
+
+
+def _get_cascade() -> "cv2.CascadeClassifier":
+    """Return this thread's cascade, constructing it on first use.
+    级联 XML 解析较慢(数十毫秒),每个线程只解析一次。注意 detectMultiScale
+    会改写分类器内部缓冲，跨线程共享同一实例会出错，所以实例按线程隔离。
+    """
+    cascade = getattr(_cascade_tls, "cascade", None)
+    if cascade is None:
+        cascade = cv2.CascadeClassifier(_get_cascade_path())
+        _cascade_tls.cascade = cascade
+    return cascade
+
+
 def load_labels() -> dict:
     if os.path.exists(LABELS_PATH):
-        with open(LABELS_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(LABELS_PATH, "rb") as f:
+            data = f.read()
+        if _orjson is not None:
+            return _orjson.loads(data)
+        return json.loads(data)
     return {"name_to_id": {}, "id_to_name": {}}
 
 
 def save_labels(labels: dict) -> None:
-    with open(LABELS_PATH, "w", encoding="utf-8") as f:
-        json.dump(labels, f, ensure_ascii=False, indent=2)
+    # 与 trainer.yml 一样先写临时文件再原子替换，读方不会看到半截 JSON
+    tmp = LABELS_PATH + ".tmp"
+    if _orjson is not None:
+        with open(tmp, "wb") as f:
+            f.write(_orjson.dumps(labels, option=_orjson.OPT_INDENT_2 | _orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(labels, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, LABELS_PATH)
 
 
 # --- Utilities & Defaults ---
 import re
 
 DEFAULT_THRESHOLD: float = 80.0  # LBPH: 越小越相似；> 阈值则视为“未知”
+DEFAULT_COSINE_THRESHOLD: float = 0.5  # 嵌入后端：余弦相似度越大越相似；< 阈值视为“未知”
+_DETECT_MAX_SIDE: float = 640.0  # 检测前把帧最长边缩到该值以内
+_NAME_RE = re.compile(r"[^0-9A-Za-z_\-\u4e00-\u9fa5]+")
 
 
 def sanitize_name(name: str) -> str:
     """Sanitize user provided name to be filesystem-safe and consistent.
     保留中英文、数字、下划线和中横线，并限制长度，避免路径穿越等问题。
     """
-    s = re.sub(r"[^0-9A-Za-z_\-\u4e00-\u9fa5]+", "_", str(name).strip())
+    s = _NAME_RE.sub("_", str(name).strip())
     return (s[:50] or "user")
 
 
@@ -76,138 +150,333 @@ def create_recognizer():
     return cv2.face.LBPHFaceRecognizer_create(radius=1, neighbors=8, grid_x=8, grid_y=8)
 
 
+_labels_lock = threading.Lock()
+
+
 def get_or_create_label_id(name: str, labels: dict) -> int:
     name = name.strip()
     if name in labels["name_to_id"]:
         return labels["name_to_id"][name]
-    new_id = 1 + max([int(i) for i in labels["id_to_name"].keys()] or [0])
-    labels["name_to_id"][name] = new_id
-    labels["id_to_name"][str(new_id)] = name
-    save_labels(labels)
+    with _labels_lock:
+        # 锁内重读磁盘，避免并发注册各自基于过期副本分配重复/丢失 id
+        fresh = load_labels()
+        if name in fresh["name_to_id"]:
+            new_id = fresh["name_to_id"][name]
+        else:
+            new_id = 1 + max([int(i) for i in fresh["id_to_name"].keys()] or [0])
+            fresh["name_to_id"][name] = new_id
+            fresh["id_to_name"][str(new_id)] = name
+            save_labels(fresh)
+        labels["name_to_id"][name] = new_id
+        labels["id_to_name"][str(new_id)] = name
     return new_id
 
 
-def decode_image_base64(image_base64: str) -> np.ndarray:
+def _remove_label_if_unused(name: str) -> None:
+    """Drop a label that ended up with no samples on disk.
+    注册整体失败时回收刚建的空身份，不让它留在 /people 里永远识别不出来；
+    只要目录里有任何样本（含历史注册的）就保留。
+    """
+    person_dir = os.path.join(DATASET_DIR, name)
+    with _labels_lock:
+        if os.path.isdir(person_dir) and any(os.scandir(person_dir)):
+            return
+        labels = load_labels()
+        label_id = labels["name_to_id"].pop(name, None)
+        if label_id is None:
+            return
+        labels["id_to_name"].pop(str(label_id), None)
+        save_labels(labels)
+
+
+def _b64_to_bytes(image_base64: str) -> bytes:
     if image_base64.startswith("data:image"):
-        image_base64 = image_base64.split(",", 1)[1]
-    img_bytes = base64.b64decode(image_base64)
+        # 切片取逗号后内容，省掉 split 的列表和前缀子串
+        image_base64 = image_base64[image_base64.index(",") + 1 :]
+    return _b64.b64decode(image_base64, validate=False)
+
+
+def _decode_image_base64(image_base64: str, flags: int) -> np.ndarray:
+    img_bytes = _b64_to_bytes(image_base64)
     img_array = np.frombuffer(img_bytes, dtype=np.uint8)
-    img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+    img = cv2.imdecode(img_array, flags)
     if img is None:
         raise ValueError("Invalid image data")
     return img
 
 
-def _iou(box_a: Tuple[int, int, int, int], box_b: Tuple[int, int, int, int]) -> float:
-    ax, ay, aw, ah = box_a
-    bx, by, bw, bh = box_b
-    ax2, ay2 = ax + aw, ay + ah
-    bx2, by2 = bx + bw, by + bh
+def decode_image_base64(image_base64: str) -> np.ndarray:
+    return _decode_image_base64(image_base64, cv2.IMREAD_COLOR)
 
-    inter_x1 = max(ax, bx)
-    inter_y1 = max(ay, by)
-    inter_x2 = min(ax2, bx2)
-    inter_y2 = min(ay2, by2)
-    inter_w = max(0, inter_x2 - inter_x1)
-    inter_h = max(0, inter_y2 - inter_y1)
-    inter_area = inter_w * inter_h
-    if inter_area <= 0:
-        return 0.0
-    area_a = aw * ah
-    area_b = bw * bh
-    return inter_area / float(area_a + area_b - inter_area + 1e-6)
+
+def decode_image_base64_gray(image_base64: str) -> np.ndarray:
+    """Decode directly to grayscale, skipping the BGR intermediate.
+    检测/识别只需要灰度图，libjpeg 直接解灰度能省一半带宽和一次 cvtColor。
+    """
+    img_bytes = _b64_to_bytes(image_base64)
+    # JPEG(SOI 头 FFD8)优先走 turbojpeg；PNG 等其它格式仍用 cv2.imdecode
+    if _turbo is not None and img_bytes[:2] == b"\xff\xd8":
+        try:
+            img = _turbo.decode(img_bytes, pixel_format=TJPF_GRAY)
+            return img[:, :, 0] if img.ndim == 3 else img
+        except Exception:
+            pass
+    img = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError("Invalid image data")
+    return img
 
 
 def _nms_boxes(boxes: List[Tuple[int, int, int, int]], iou_threshold: float = 0.35) -> List[Tuple[int, int, int, int]]:
+    """Greedy NMS, largest box first, vectorized with NumPy broadcasting.
+    每轮用向量运算算出当前保留框对剩余框的 IoU，一次性筛掉重叠框。
+    """
     if len(boxes) <= 1:
         return boxes
-    # sort by area descending
-    boxes_sorted = sorted(boxes, key=lambda b: b[2] * b[3], reverse=True)
-    kept: List[Tuple[int, int, int, int]] = []
-    for b in boxes_sorted:
-        if all(_iou(b, k) < iou_threshold for k in kept):
-            kept.append(b)
-    return kept
-
-
-def detect_faces_bgr(image_bgr: np.ndarray) -> List[Tuple[int, int, int, int]]:
-    cascade_path = ensure_cascade()
+    arr = np.asarray(boxes, dtype=np.float32)
+    x1, y1 = arr[:, 0], arr[:, 1]
+    x2, y2 = x1 + arr[:, 2], y1 + arr[:, 3]
+    areas = arr[:, 2] * arr[:, 3]
+    order = np.argsort(-areas)
+    kept: List[int] = []
+    while order.size > 0:
+        i = order[0]
+        kept.append(int(i))
+        rest = order[1:]
+        if rest.size == 0:
+            break
+        iw = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        ih = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = iw * ih
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-6)
+        order = rest[iou < iou_threshold]
+    return [boxes[i] for i in kept]
+
+
+def _prepare_detect_input(gray_raw: np.ndarray):
+    """Build the per-frame detection input exactly once.
+    直方图均衡、降采样、UMat 上传(进而级联内部的积分图构建输入)每帧只做
+    一次；之后若叠加多个级联(正脸 + 侧脸等)直接复用,不重复这段内存密集
+    的预处理。
+    """
     # Improve robustness with histogram equalization
-    gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
-    gray = cv2.equalizeHist(gray)
+    gray = cv2.equalizeHist(gray_raw)
     h, w = gray.shape[:2]
     # 自适应最小人脸尺寸，避免远距离/小脸漏检；至少 80px
     min_side = min(w, h)
     min_size = int(max(80, min_side * 0.2))
-    face_cascade = cv2.CascadeClassifier(cascade_path)
-    faces = face_cascade.detectMultiScale(
-        gray,
+    # 检测成本随分辨率近似平方增长；大帧先缩到最长边 640 再检测，框按比例放回
+    scale = min(1.0, _DETECT_MAX_SIDE / float(max(h, w)))
+    if scale < 1.0:
+        gray_det = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        min_size = max(1, int(min_size * scale))
+    else:
+        gray_det = gray
+    # UMat 上传让 detectMultiScale 走 OCL 内核;失败则回退 CPU
+    detect_input = gray_det
+    if _HAS_OCL:
+        try:
+            detect_input = cv2.UMat(gray_det)
+        except Exception:
+            detect_input = gray_det
+    return detect_input, scale, min_size
+
+
+def _run_cascade(cascade, detect_input, scale: float, min_size: int) -> List[Tuple[int, int, int, int]]:
+    faces = cascade.detectMultiScale(
+        detect_input,
         scaleFactor=1.08,
         minNeighbors=6,
         minSize=(min_size, min_size)
     )
+    return [tuple(int(v / scale) for v in f) for f in faces]
+
+
+def detect_faces_gray(gray_raw: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    """Detect faces on an already-grayscale image.
+    调用方往往还要用同一张灰度图做裁剪/识别，直接收灰度图避免重复 cvtColor。
+    """
+    detect_input, scale, min_size = _prepare_detect_input(gray_raw)
+    faces_list = _run_cascade(_get_cascade(), detect_input, scale, min_size)
     # Deduplicate highly overlapping boxes (sometimes cascade returns multiple for one face)
-    faces_list: List[Tuple[int, int, int, int]] = [tuple(map(int, f)) for f in faces]
     faces_nms = _nms_boxes(faces_list, iou_threshold=0.35)
     return faces_nms
 
 
-def save_face_sample(name: str, image_bgr: np.ndarray) -> str:
+def detect_faces_bgr(image_bgr: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    return detect_faces_gray(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY))
+
+
+def save_face_sample(name: str, image_gray: np.ndarray, label_id: Optional[int] = None) -> str:
     safe_name = sanitize_name(name)
-    faces = detect_faces_bgr(image_bgr)
+    gray = image_gray
+    faces = detect_faces_gray(gray)
     if len(faces) == 0:
         raise ValueError("未检测到人脸")
     # Take the largest face
     x, y, w, h = sorted(faces, key=lambda b: b[2] * b[3], reverse=True)[0]
-    gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
     face_gray = gray[y : y + h, x : x + w]
     # Normalize to fixed size for recognizer
     face_gray = cv2.resize(face_gray, (200, 200))
     person_dir = os.path.join(DATASET_DIR, safe_name)
     os.makedirs(person_dir, exist_ok=True)
-    idx = 1
-    while True:
-        filename = os.path.join(person_dir, f"{idx:03d}.png")
-        if not os.path.exists(filename):
-            break
-        idx += 1
+    # uuid 文件名天然无冲突：免去逐个 stat 的探测循环，也不怕并发注册抢同名
+    filename = os.path.join(person_dir, f"{uuid.uuid4().hex}.png")
     cv2.imwrite(filename, face_gray)
+    # 嵌入后端可用时顺带记一行向量，识别侧就不依赖 LBPH 重训
+    session = _get_embedder()
+    if session is not None:
+        if label_id is None:
+            label_id = get_or_create_label_id(safe_name, load_labels())
+        _embedding_store.add(label_id, _embed_face(session, face_gray))
     return filename
 
 
-def build_training_data() -> Tuple[List[np.ndarray], List[int]]:
+# 已解码的训练样本缓存：200×200 灰度图每张约 40KB，常驻内存代价很小
+_SAMPLE_CACHE: Dict[str, Tuple[float, np.ndarray]] = {}
+_sample_cache_lock = threading.Lock()
+
+
+def _load_sample_cached(path: str) -> Optional[np.ndarray]:
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _sample_cache_lock:
+        hit = _SAMPLE_CACHE.get(path)
+        if hit is not None and hit[0] == mtime:
+            return hit[1]
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    with _sample_cache_lock:
+        _SAMPLE_CACHE[path] = (mtime, img)
+    return img
+
+
+def _collect_sample_paths() -> List[Tuple[str, int]]:
     labels = load_labels()
+    pairs: List[Tuple[str, int]] = []
+    # scandir 的 DirEntry 自带缓存的 stat 信息，比 listdir + isdir 少一半系统调用
+    with os.scandir(DATASET_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            label_id = get_or_create_label_id(entry.name, labels)
+            with os.scandir(entry.path) as files:
+                for file_entry in files:
+                    if not file_entry.name.lower().endswith((".png", ".jpg", ".jpeg")):
+                        continue
+                    pairs.append((file_entry.path, label_id))
+    return pairs
+
+
+def _decode_pairs(pairs: List[Tuple[str, int]]) -> Tuple[List[np.ndarray], List[int], List[str]]:
     images: List[np.ndarray] = []
     ids: List[int] = []
-    for name in os.listdir(DATASET_DIR):
-        person_dir = os.path.join(DATASET_DIR, name)
-        if not os.path.isdir(person_dir):
-            continue
-        label_id = get_or_create_label_id(name, labels)
-        for file in os.listdir(person_dir):
-            if not file.lower().endswith((".png", ".jpg", ".jpeg")):
-                continue
-            path = os.path.join(person_dir, file)
-            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    paths: List[str] = []
+    if len(pairs) == 0:
+        return images, ids, paths
+    # cv2.imread 在 C 代码里释放 GIL，线程池把磁盘 IO 和 PNG 解码摊到多核
+    workers = min(8, os.cpu_count() or 1, len(pairs))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        decoded = pool.map(lambda pair: _load_sample_cached(pair[0]), pairs)
+        for (path, label_id), img in zip(pairs, decoded):
             if img is None:
                 continue
             images.append(img)
             ids.append(label_id)
+            paths.append(path)
+    return images, ids, paths
+
+
+def build_training_data() -> Tuple[List[np.ndarray], List[int]]:
+    images, ids, _ = _decode_pairs(_collect_sample_paths())
     return images, ids
 
 
-def train_model_async():
-    def _train():
-        images, ids = build_training_data()
+def _load_trained_files() -> set:
+    if os.path.exists(TRAINED_FILES_PATH):
+        try:
+            with open(TRAINED_FILES_PATH, "r", encoding="utf-8") as f:
+                return set(json.load(f))
+        except Exception:
+            return set()
+    return set()
+
+
+def _save_trained_files(paths) -> None:
+    tmp = TRAINED_FILES_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(sorted(paths), f, ensure_ascii=False, indent=2)
+    os.replace(tmp, TRAINED_FILES_PATH)
+
+
+def _train_once() -> None:
+    pairs = _collect_sample_paths()
+    if len(pairs) == 0:
+        return
+    current = {p for p, _ in pairs}
+    seen = _load_trained_files()
+    # 样本只增不减时走 LBPH 增量 update，代价只与新增样本数有关；
+    # 有删除/改名则回退全量重训，避免模型里残留已删身份
+    incremental = bool(seen) and seen <= current and os.path.exists(TRAINER_PATH)
+    if incremental:
+        new_pairs = [(p, l) for p, l in pairs if p not in seen]
+        if len(new_pairs) == 0:
+            return
+        images, ids, ok_paths = _decode_pairs(new_pairs)
+        if len(images) == 0:
+            return
+        recognizer = load_recognizer()
+        if recognizer is None:
+            incremental = False
+        else:
+            recognizer.update(images, np.array(ids))
+            trained = seen | set(ok_paths)
+    if not incremental:
+        images, ids, ok_paths = _decode_pairs(pairs)
         if len(images) == 0:
             return
         recognizer = create_recognizer()
         recognizer.train(images, np.array(ids))
-        tmp = TRAINER_PATH + ".tmp"
-        recognizer.save(tmp)
-        os.replace(tmp, TRAINER_PATH)
+        trained = set(ok_paths)
+    tmp = TRAINER_PATH + ".tmp"
+    recognizer.save(tmp)
+    os.replace(tmp, TRAINER_PATH)
+    # 训练结果直接换入缓存；trainer.yml 只用于重启后恢复
+    _recognizer_cache.put(recognizer)
+    _save_trained_files(trained)
+
 
-    threading.Thread(target=_train, daemon=True).start()
+_train_event = threading.Event()
+_train_worker_lock = threading.Lock()
+_train_worker: Optional[threading.Thread] = None
+
+
+def _train_worker_loop() -> None:
+    while True:
+        _train_event.wait()
+        # 训练前先清标志：期间再来的注册会重新置位，训练完会再跑一轮
+        _train_event.clear()
+        try:
+            _train_once()
+        except Exception:
+            # 后台训练失败不影响服务，下次注册会再次触发；但一定要留下现场
+            traceback.print_exc()
+
+
+def train_model_async():
+    """Schedule a retrain, coalescing bursts into at most one pending run.
+    连续注册 N 张图不再起 N 个线程各自全量重训：常驻 worker 被事件唤醒，
+    训练期间新的请求只是把事件再置位。
+    """
+    global _train_worker
+    with _train_worker_lock:
+        if _train_worker is None:
+            _train_worker = threading.Thread(target=_train_worker_loop, daemon=True)
+            _train_worker.start()
+    _train_event.set()
 
 
 def load_recognizer():
@@ -218,6 +487,136 @@ def load_recognizer():
     return recognizer
 
 
+class _FileCache:
+    """Cache a file-backed object, reloading only when the file mtime changes.
+    按 mtime 失效的进程内缓存;后台重训通过 os.replace 原子替换文件,
+    这里用锁保证换入新对象时不会读到半旧状态。
+    """
+
+    def __init__(self, path: str, loader):
+        self._path = path
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = -1.0  # sentinel: force load on first access
+        self._obj = None
+
+    def get(self):
+        try:
+            mtime: Optional[float] = os.stat(self._path).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime != self._mtime:
+                self._obj = self._loader()
+                self._mtime = mtime
+            return self._obj
+
+    def put(self, obj) -> None:
+        """Swap in an object already built in-process, keyed to the file's current mtime.
+        训练线程刚得到的模型直接换入，读方不必再从文件反序列化一遍。
+        """
+        try:
+            mtime: Optional[float] = os.stat(self._path).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            self._obj = obj
+            self._mtime = mtime
+
+
+_recognizer_cache = _FileCache(TRAINER_PATH, load_recognizer)
+_labels_cache = _FileCache(LABELS_PATH, load_labels)
+
+
+def get_recognizer_cached():
+    return _recognizer_cache.get()
+
+
+def get_labels_cached() -> dict:
+    return _labels_cache.get()
+
+
+# --- Embedding-based recognition (optional ONNX backend) ---
+# 把 model/face_embedder.onnx(如 MobileFaceNet)放到 model 目录并安装
+# onnxruntime 即启用：注册只是往矩阵 append 一行嵌入向量，识别是一次
+# gemv 余弦检索，都不需要重训；缺模型或缺依赖时完全回退 LBPH。
+
+
+@lru_cache(maxsize=1)
+def _get_embedder():
+    if not USE_EMBEDDINGS or _ort is None or not os.path.exists(EMBEDDER_PATH):
+        return None
+    try:
+        return _ort.InferenceSession(EMBEDDER_PATH, providers=["CPUExecutionProvider"])
+    except Exception:
+        return None
+
+
+def _embed_face(session, face_gray: np.ndarray) -> np.ndarray:
+    inp = session.get_inputs()[0]
+    side = inp.shape[-1] if isinstance(inp.shape[-1], int) else 112
+    face = cv2.resize(face_gray, (side, side), interpolation=cv2.INTER_LINEAR)
+    blob = cv2.cvtColor(face, cv2.COLOR_GRAY2RGB).astype(np.float32)
+    blob = (blob - 127.5) / 128.0
+    blob = np.transpose(blob, (2, 0, 1))[None, ...]
+    emb = session.run(None, {inp.name: blob})[0].reshape(-1).astype(np.float32)
+    # L2 归一化后内积即余弦相似度
+    return emb / (np.linalg.norm(emb) + 1e-12)
+
+
+class _EmbeddingStore:
+    """Append-only store of L2-normalized embeddings with cosine search."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None  # (N, D)
+        self._ids: Optional[np.ndarray] = None  # (N,)
+        self._loaded = False
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        if os.path.exists(self._path):
+            try:
+                data = np.load(self._path)
+                self._matrix = data["embeddings"]
+                self._ids = data["ids"]
+            except Exception:
+                pass
+        self._loaded = True
+
+    def add(self, label_id: int, embedding: np.ndarray) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            row = embedding.reshape(1, -1)
+            if self._matrix is None:
+                self._matrix = row
+                self._ids = np.array([label_id], dtype=np.int64)
+            else:
+                self._matrix = np.vstack([self._matrix, row])
+                self._ids = np.append(self._ids, np.int64(label_id))
+            tmp = self._path + ".tmp"
+            with open(tmp, "wb") as f:
+                np.savez(f, embeddings=self._matrix, ids=self._ids)
+            os.replace(tmp, self._path)
+
+    def search(self, embedding: np.ndarray) -> Optional[Tuple[int, float]]:
+        with self._lock:
+            self._ensure_loaded()
+            if self._matrix is None or len(self._matrix) == 0:
+                return None
+            scores = self._matrix @ embedding
+            best = int(np.argmax(scores))
+            return int(self._ids[best]), float(scores[best])
+
+
+_embedding_store = _EmbeddingStore(EMBEDDINGS_PATH)
+
+
+_register_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 4))
+
+
 class RegisterPayload(BaseModel):
     name: str
     image_base64: object  # str 或 List[str]
@@ -250,19 +649,31 @@ def register(payload: RegisterPayload):
         raise HTTPException(status_code=400, detail="缺少参数")
     try:
         safe_name = sanitize_name(payload.name)
+        # 进池前先把 label id 定下来，工作线程就不会各自读写 labels.json
+        labels_before = load_labels()
+        was_known = safe_name in labels_before["name_to_id"]
+        label_id = get_or_create_label_id(safe_name, labels_before)
         saved = []
-        if isinstance(payload.image_base64, list):
-            for item in payload.image_base64:
-                img = decode_image_base64(item)
-                path = save_face_sample(safe_name, img)
+        try:
+            if isinstance(payload.image_base64, list):
+                # 解码/检测/写盘都在 OpenCV C 代码里释放 GIL，多张图并行处理。
+                # 检测线程安全依赖 _get_cascade 的 per-thread 实例；常驻池复用
+                # 工作线程，级联也就不会每个请求重新解析
+                def _one(item: str) -> str:
+                    return save_face_sample(safe_name, decode_image_base64_gray(item), label_id)
+
+                futures = [_register_pool.submit(_one, item) for item in payload.image_base64]
+                for fut in as_completed(futures):
+                    saved.append(fut.result())
+            else:
+                gray = decode_image_base64_gray(str(payload.image_base64))
+                path = save_face_sample(safe_name, gray, label_id)
                 saved.append(path)
-        else:
-            img = decode_image_base64(str(payload.image_base64))
-            path = save_face_sample(safe_name, img)
-            saved.append(path)
-        # ensure label exists and save
-        labels = load_labels()
-        _ = get_or_create_label_id(safe_name, labels)
+        except Exception:
+            # 一张样本都没落盘就失败时，回收刚创建的空标签（部分成功则保留）
+            if not was_known:
+                _remove_label_if_unused(safe_name)
+            raise
         # retrain in background
         train_model_async()
         return {"ok": True, "saved": saved}
@@ -273,21 +684,45 @@ def register(payload: RegisterPayload):
 @app.post("/recognize")
 def recognize(payload: RecognizePayload):
     try:
-        img = decode_image_base64(payload.image_base64)
-        faces = detect_faces_bgr(img)
+        gray = decode_image_base64_gray(payload.image_base64)
+        faces = detect_faces_gray(gray)
         if len(faces) == 0:
             return {"ok": True, "result": []}
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        recognizer = load_recognizer()
-        labels = load_labels()
+        labels = get_labels_cached()
         results = []
+        session = _get_embedder()
+        if session is not None:
+            # 嵌入后端：一次前向 + 矩阵内积检索；阈值是余弦相似度(越大越相似)。
+            # 前端沿用 LBPH 距离刻度(如默认的 80)时值必然 > 1，此时退回默认
+            # 余弦阈值，避免把两种量纲混在一起导致所有脸都判成“未知”
+            thr = DEFAULT_COSINE_THRESHOLD
+            if payload.threshold is not None and float(payload.threshold) <= 1.0:
+                thr = float(payload.threshold)
+            for (x, y, w, h) in faces:
+                hit = _embedding_store.search(_embed_face(session, gray[y : y + h, x : x + w]))
+                if hit is None:
+                    results.append({"rect": [int(x), int(y), int(w), int(h)], "name": "未知", "confidence": None})
+                    continue
+                label_id, score = hit
+                name = labels["id_to_name"].get(str(label_id), "未知")
+                if score < thr:
+                    name = "未知"
+                results.append({
+                    "rect": [int(x), int(y), int(w), int(h)],
+                    "name": name,
+                    "confidence": float(score),
+                })
+            return {"ok": True, "result": results, "threshold": thr}
+        recognizer = get_recognizer_cached()
         thr = float(payload.threshold) if payload.threshold is not None else DEFAULT_THRESHOLD
+        # 复用同一块 200×200 缓冲，多张脸时省掉每张一次的分配
+        face_buf = np.empty((200, 200), dtype=np.uint8)
         for (x, y, w, h) in faces:
-            face = cv2.resize(gray[y : y + h, x : x + w], (200, 200))
             if recognizer is None:
                 results.append({"rect": [int(x), int(y), int(w), int(h)], "name": "未知", "confidence": None})
                 continue
-            label_id, dist = recognizer.predict(face)
+            cv2.resize(gray[y : y + h, x : x + w], (200, 200), dst=face_buf, interpolation=cv2.INTER_LINEAR)
+            label_id, dist = recognizer.predict(face_buf)
             name = labels["id_to_name"].get(str(label_id), "未知")
             if dist > thr:
                 name = "未知"
@@ -303,7 +738,7 @@ def recognize(payload: RecognizePayload):
 
 @app.post("/train")
 def train():
-    images, ids = build_training_data()
+    images, ids, ok_paths = _decode_pairs(_collect_sample_paths())
     if len(images) == 0:
         raise HTTPException(status_code=400, detail="没有训练样本")
     recognizer = create_recognizer()
@@ -311,6 +746,8 @@ def train():
     tmp = TRAINER_PATH + ".tmp"
     recognizer.save(tmp)
     os.replace(tmp, TRAINER_PATH)
+    _recognizer_cache.put(recognizer)
+    _save_trained_files(ok_paths)
     return {"ok": True, "samples": len(images)}
 
 